@@ -1,16 +1,103 @@
+import fcntl
+import functools
 import hashlib
 import json
 import os
+import re
+import shutil
 import subprocess
+import tempfile
 import types
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
 from textwrap import dedent, indent
 
-from west.commands import WestCommand, extension_commands
+from west.commands import Verbosity, WestCommand, extension_commands
 from west.manifest import Manifest
 from west.util import west_dir
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_FETCHGIT_TEMPLATE = dedent(
+    """
+    fetchgit {{
+        url = "{url}";
+        rev = "{rev}";
+        branchName = "manifest-rev";
+        hash = "{hash}";
+    }}"""
+)
+
+_FETCHURL_TEMPLATE = dedent(
+    """
+    fetchurl {{
+        url = "{url}";
+        hash = "sha256:{sha256}";
+    }}"""
+)
+
+
+def _dump_json(obj, indent=True):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None).encode("utf-8")
+
+
+def _load_json(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+@functools.lru_cache(maxsize=None)
+def _nix_prefetch_git_path():
+    # subprocess only uses posix_spawn() if given a path to the executable
+    return shutil.which("nix-prefetch-git") or "nix-prefetch-git"
+
+
+def _is_commit_hash(rev):
+    return re.fullmatch(r"[0-9a-f]{40}|[0-9a-f]{64}", rev) is not None
+
+
+def _cache_dir():
+    # The XDG spec says relative paths must be ignored
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not cache_home or not os.path.isabs(cache_home):
+        cache_home = os.path.expanduser("~/.cache")
+    return Path(cache_home) / "west-nix"
+
+
+def _global_cache_path():
+    return _cache_dir() / "prefetch.jsonl"
+
+
+def _mirror_path(url):
+    return (
+        _cache_dir()
+        / "git"
+        / hashlib.blake2b(url.encode("utf-8"), digest_size=16).hexdigest()
+    )
+
+
+def _cache_key(url, rev):
+    # Hash project data into a cache key. The hashed data must not be
+    # ambiguous, so separate fields with NUL bytes.
+    return hashlib.blake2b(
+        f"{url}\0{rev}\0manifest-rev".encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+def _legacy_cache_key(url, rev):
+    cache_key = hashlib.sha256()
+    cache_key.update(url.encode("utf-8"))
+    cache_key.update(rev.encode("utf-8"))
+    cache_key.update(b"manifest-rev")
+    return cache_key.hexdigest()
+
 
 @dataclass
 class LinkPath:
@@ -37,6 +124,42 @@ class Nix(WestCommand):
         parser = parser_adder.add_parser(
             self.name, help=self.help, description=self.description
         )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            # argparse applies type to string defaults, so an invalid
+            # $WEST_NIX_JOBS is reported like an invalid argument
+            default=(
+                os.environ.get("WEST_NIX_JOBS") or min((os.cpu_count() or 1) * 2, 16)
+            ),
+            help="""maximum number of nix-prefetch-git processes to run in
+            parallel (default: $WEST_NIX_JOBS, or twice the CPU count up to
+            16)""",
+        )
+        parser.add_argument(
+            "--cache",
+            type=Path,
+            # Treat an empty $WEST_NIX_CACHE as unset
+            default=os.environ.get("WEST_NIX_CACHE") or None,
+            help="""path of the source hash cache (default: $WEST_NIX_CACHE,
+            or .west-nix-cache.json next to west.nix)""",
+        )
+        parser.add_argument(
+            "--no-shared-cache",
+            dest="shared_cache",
+            action="store_false",
+            help="""don't use or update the source hash cache shared between
+            workspaces in $XDG_CACHE_HOME/west-nix""",
+        )
+        parser.add_argument(
+            "--mirror",
+            action="store_true",
+            help="""fetch sources through bare git mirrors kept in
+            $XDG_CACHE_HOME/west-nix/git, so that changing a project's
+            revision only downloads new objects. Mirrors contain the full
+            history of each fetched revision, so the first fetch is slower.""",
+        )
 
         return parser
 
@@ -48,36 +171,55 @@ class Nix(WestCommand):
         # Directory containing the manifest YAML
         manifest_dir = manifest_path.parent
         west_nix_path = manifest_dir / "west.nix"
-        cache_path = Path(west_dir()) / "west-nix-cache.json"
+        if args.cache is not None:
+            cache_path = Path(args.cache)
+            legacy_cache_path = None
+            if cache_path.is_dir():
+                self.die(f"cache path {cache_path} is a directory")
+            # Fail before prefetching anything if the cache can't be written
+            try:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+            except OSError as e:
+                self.die(f"failed to create cache directory: {e}")
+        else:
+            # Keep the cache next to west.nix so both are written to the same
+            # filesystem
+            cache_path = manifest_dir / ".west-nix-cache.json"
+            # Older versions stored the cache in the west directory
+            legacy_cache_path = Path(west_dir()) / "west-nix-cache.json"
         top_dir = Path(manifest.topdir)
-        top_dir_relative_to_manifest_dir = Path(os.path.relpath(top_dir, manifest_dir))
+        top_dir_relative_to_manifest_dir = os.path.relpath(top_dir, manifest_dir)
 
         zephyr_base = os.environ.get("ZEPHYR_BASE")
         if zephyr_base is not None:
             zephyr_base = Path(zephyr_base)
 
-        blobs = []
-        # Locate and call the Zephyr "blobs" extension command. This is probably
-        # a bit brittle.
-        zephyr_cmds = extension_commands(self.config, manifest).get("zephyr")
-        if zephyr_cmds is not None:
-            self.dbg("found Zephyr extension commands")
-            blob_cmd_spec = next(
-                (cmd for cmd in zephyr_cmds if cmd.name == "blobs"), None
+        # Loading the cache and finding blobs are independent of the manifest
+        # projects, so do them in the background while computing cache keys
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            blobs_future = executor.submit(self._get_blobs)
+            cache_future = executor.submit(
+                self._load_cache, cache_path, legacy_cache_path
             )
-            if blob_cmd_spec is not None:
-                self.dbg("found Zephyr blobs commands")
-                blob_cmd = blob_cmd_spec.factory()
-                blob_cmd.topdir = self.topdir
-                blob_cmd.manifest = self.manifest
-                blob_cmd.config = self.config
-                blobs = blob_cmd.get_blobs(types.SimpleNamespace(modules=[]))
 
-        try:
-            with open(cache_path) as cache_file:
-                cache = json.load(cache_file)
-        except (FileNotFoundError, json.JSONDecodeError):
-            cache = {}
+            # Find the active projects once, so later passes can just iterate
+            # over them
+            active_projects = []
+            for project in manifest.projects:
+                if manifest.is_active(project):
+                    active_projects.append(project)
+                # Avoid formatting the message if it won't be printed
+                elif self.verbosity >= Verbosity.DBG:
+                    self.dbg(f"{project.name}: skipping inactive project")
+
+            # Find the cache key of each active project
+            cache_keys = [
+                _cache_key(p.url, p.revision) if p.url else None
+                for p in active_projects
+            ]
+
+            blobs = blobs_future.result()
+            cache = cache_future.result()
         project_hashes = cache.setdefault("project_hashes", {})
 
         # Only projects that are still included in the manifest are written back
@@ -85,26 +227,63 @@ class Nix(WestCommand):
         new_cache = {}
         new_project_hashes = new_cache.setdefault("project_hashes", {})
 
-        zephyr_modules = []
-        paths = []
-        for project in manifest.projects:
-            if not self.manifest.is_active(project):
-                self.dbg(f"{project.name}: skipping inactive project")
+        # Find the source hashes using the cache. Projects with the same URL and
+        # revision share a cache key, so each is only prefetched once.
+        hashes = {}
+        missing = {}
+        for project, cache_key in zip(active_projects, cache_keys):
+            if cache_key is None or cache_key in hashes or cache_key in missing:
                 continue
+            hash_str = project_hashes.get(cache_key, {}).get("hash")
+            if hash_str is None:
+                # Fall back to the key used by older versions so that existing
+                # caches are migrated rather than refetched
+                legacy_key = _legacy_cache_key(project.url, project.revision)
+                hash_str = project_hashes.get(legacy_key, {}).get("hash")
+            if hash_str is None:
+                missing[cache_key] = (project.url, project.revision)
+            else:
+                hashes[cache_key] = hash_str
+
+        # Fall back to the cache shared between workspaces. Only revisions that
+        # are commit hashes are shared, since branches and tags can move.
+        global_cache_path = _global_cache_path()
+        shared = []
+        if args.shared_cache:
+            shared = [k for k, (_, rev) in missing.items() if _is_commit_hash(rev)]
+        if shared:
+            global_hashes, _ = self._load_global_cache(global_cache_path)
+            for cache_key in shared:
+                hash_str = global_hashes.get(cache_key, {}).get("hash")
+                if hash_str is not None:
+                    hashes[cache_key] = hash_str
+                    del missing[cache_key]
 
-            if project.url:
-                # Hash project data into a cache key
-                cache_key = hashlib.sha256()
-                cache_key.update(project.url.encode("utf-8"))
-                cache_key.update(project.revision.encode("utf-8"))
-                cache_key.update(b"manifest-rev")
-                cache_key = cache_key.hexdigest()
-
-                # Find the source hash using the cache or nix-prefetch-git
-                hash_str = project_hashes.get(cache_key, {}).get("hash")
-                if hash_str is None:
-                    prefetch = self._nix_prefetch_git(project.url, project.revision)
-                    hash_str = prefetch["hash"]
+        # Prefetch uncached projects in parallel. This is network bound, so
+        # threads are sufficient.
+        if missing:
+            self.dbg(f"prefetching {len(missing)} projects")
+            try:
+                self._prefetch(missing, hashes, args.jobs, args.mirror)
+            finally:
+                # Save whatever was prefetched, even if the run fails, so it
+                # isn't fetched again next time
+                self._update_global_cache(
+                    global_cache_path,
+                    {
+                        k: {"url": url, "rev": rev, "hash": hashes[k]}
+                        for k, (url, rev) in missing.items()
+                        if k in shared and k in hashes
+                    },
+                )
+
+        zephyr_modules = []
+        paths = []
+        for project, cache_key in zip(active_projects, cache_keys):
+            # Only used for LinkPath; plain strings are used everywhere else
+            project_path = Path(project.path)
+            if cache_key is not None:
+                hash_str = hashes[cache_key]
                 new_project_hashes[cache_key] = {
                     # These attributes are just for informational purposes
                     "url": project.url,
@@ -114,15 +293,9 @@ class Nix(WestCommand):
 
                 paths.append(
                     LinkPath(
-                        path=Path(project.path),
-                        src=dedent(
-                            f"""
-                        fetchgit {{
-                            url = "{project.url}";
-                            rev = "{project.revision}";
-                            branchName = "manifest-rev";
-                            hash = "{hash_str}";
-                        }}"""
+                        path=project_path,
+                        src=_FETCHGIT_TEMPLATE.format(
+                            url=project.url, rev=project.revision, hash=hash_str
                         ),
                         is_dir=True,
                     )
@@ -130,86 +303,293 @@ class Nix(WestCommand):
             else:
                 paths.append(
                     LinkPath(
-                        path=Path(project.path),
-                        src=f'"${{{top_dir_relative_to_manifest_dir / project.path}}}"',
+                        path=project_path,
+                        src=f'"${{{top_dir_relative_to_manifest_dir}/{project.path}}}"',
                         is_dir=True,
                     )
                 )
 
-            if (Path(project.path) / "zephyr" / "module.yml").exists():
+            if os.path.isfile(os.path.join(project.path, "zephyr", "module.yml")):
                 zephyr_modules.append(project.path)
 
         for blob in blobs:
             paths.append(
                 LinkPath(
                     path=Path(os.path.relpath(blob["abspath"], top_dir)),
-                    src=dedent(
-                        f"""
-                    fetchurl {{
-                        url = "{blob["url"]}";
-                        hash = "sha256:{blob["sha256"]}";
-                    }}"""
+                    src=_FETCHURL_TEMPLATE.format(
+                        url=blob["url"], sha256=blob["sha256"]
                     ),
                     is_dir=False,
                 )
             )
 
-        with open(west_nix_path, "w") as west_nix:
-            print(
-                """
+        west_nix = []
+        west_nix.append(
+            """
 { lib, runCommand, lndir, fetchgit, fetchurl }:
 
 runCommand "west-workspace" {
 nativeBuildInputs = [ lndir ];
-} ''""",
-                file=west_nix,
-            )
+} ''"""
+        )
 
-            for path in paths:
-                src = indent(f"${{lib.escapeShellArg ({path.src})}}", "        ")
-                if path.is_dir:
-                    print(
-                        f"""
+        for path in paths:
+            src = indent(f"${{lib.escapeShellArg ({path.src})}}", "        ")
+            if path.is_dir:
+                west_nix.append(
+                    f"""
     mkdir -p "$out"/'{path.path}'
     lndir -silent \\
 {src} \\
-        "$out"/'{path.path}'""",
-                        file=west_nix,
-                    )
-                else:
-                    print(
-                        f"""
+        "$out"/'{path.path}'"""
+                )
+            else:
+                west_nix.append(
+                    f"""
     mkdir -p "$out"/'{path.path.parent}'
     ln -s \\
 {src} \\
-        "$out"/'{path.path}'""",
-                        file=west_nix,
-                    )
-
-            if zephyr_base is not None:
-                zephyr_base_placeholder = (
-                    '${placeholder "out"}' / zephyr_base.relative_to(top_dir)
+        "$out"/'{path.path}'"""
                 )
-                zephyr_modules_placeholder = (
-                    f'${{placeholder "out"}}/{m}' for m in zephyr_modules
-                )
-                print(
-                    f"""
+
+        if zephyr_base is not None:
+            zephyr_base_placeholder = (
+                '${placeholder "out"}' / zephyr_base.relative_to(top_dir)
+            )
+            zephyr_modules_placeholder = ";".join(
+                [f'${{placeholder "out"}}/{m}' for m in zephyr_modules]
+            )
+            west_nix.append(
+                f"""
     cat << EOF > "$out/.zephyr-env"
     export ZEPHYR_BASE=${{lib.escapeShellArg "{zephyr_base_placeholder}"}}
-    export ZEPHYR_MODULES=${{lib.escapeShellArg "{";".join(zephyr_modules_placeholder)}"}}
+    export ZEPHYR_MODULES=${{lib.escapeShellArg "{zephyr_modules_placeholder}"}}
     EOF
-''""",
-                    file=west_nix,
-                )
+''"""
+            )
+
+        # Leave west.nix untouched if it is already up to date, so that a run
+        # with a warm cache doesn't write anything
+        west_nix = ("\n".join(west_nix) + "\n").encode("utf-8")
+        try:
+            with open(west_nix_path, "rb") as west_nix_file:
+                west_nix_changed = west_nix_file.read() != west_nix
+        except FileNotFoundError:
+            west_nix_changed = True
+        if west_nix_changed:
+            self._write_atomic(west_nix_path, west_nix)
+
+        # Avoid rewriting the cache if nothing changed
+        if new_cache != cache or not cache_path.exists():
+            self._write_atomic(cache_path, _dump_json(new_cache))
+
+    def _get_blobs(self):
+        # Locate and call the Zephyr "blobs" extension command. This is probably
+        # a bit brittle.
+        zephyr_cmds = extension_commands(self.config, self.manifest).get("zephyr")
+        if zephyr_cmds is None:
+            return []
+        self.dbg("found Zephyr extension commands")
+        blob_cmd_spec = next((cmd for cmd in zephyr_cmds if cmd.name == "blobs"), None)
+        if blob_cmd_spec is None:
+            return []
+        self.dbg("found Zephyr blobs commands")
+        blob_cmd = blob_cmd_spec.factory()
+        blob_cmd.topdir = self.topdir
+        blob_cmd.manifest = self.manifest
+        blob_cmd.config = self.config
+        return blob_cmd.get_blobs(types.SimpleNamespace(modules=[]))
+
+    def _load_cache(self, cache_path, legacy_cache_path=None):
+        try:
+            with open(cache_path, "rb") as cache_file:
+                return _load_json(cache_file.read())
+        except FileNotFoundError:
+            if legacy_cache_path is not None:
+                return self._load_cache(legacy_cache_path)
+            return {}
+        except json.JSONDecodeError:
+            return {}
+
+    def _load_global_cache(self, cache_path):
+        # The shared cache is an append-only log with one JSON object per
+        # line. Returns the entries and the number of lines in the log.
+        project_hashes = {}
+        lines = 0
+        try:
+            with open(cache_path, "rb") as cache_file:
+                for line in cache_file:
+                    lines += 1
+                    # Ignore broken lines, most likely truncated by an
+                    # interrupted write. ValueError includes JSONDecodeError
+                    # as well as UnicodeDecodeError for a line cut off in the
+                    # middle of a character.
+                    try:
+                        entry = _load_json(line)
+                    except ValueError:
+                        continue
+                    if (
+                        not isinstance(entry, dict)
+                        or not isinstance(entry.get("key"), str)
+                        or not isinstance(entry.get("hash"), str)
+                    ):
+                        continue
+                    project_hashes[entry.pop("key")] = entry
+        except FileNotFoundError:
+            pass
+        return project_hashes, lines
+
+    def _update_global_cache(self, cache_path, project_hashes):
+        if not project_hashes:
+            return
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # Readers don't need the lock, since they ignore incomplete lines.
+            # It only prevents concurrent updates from interleaving or losing
+            # entries.
+            with open(cache_path.with_suffix(".lock"), "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                cache, lines = self._load_global_cache(cache_path)
+                # Another process may have added some of the entries already
+                new_entries = {
+                    k: v for k, v in project_hashes.items() if k not in cache
+                }
+                cache.update(new_entries)
+
+                def dump(entries):
+                    return b"".join(
+                        _dump_json({"key": k, **v}, indent=False) + b"\n"
+                        for k, v in entries.items()
+                    )
+
+                if lines + len(new_entries) > 2 * len(cache):
+                    # Compact the log if it is mostly duplicate or broken lines
+                    self._write_atomic(cache_path, dump(cache))
+                elif new_entries:
+                    with open(cache_path, "a+b") as cache_file:
+                        data = dump(new_entries)
+                        # Terminate a truncated line so it doesn't corrupt the
+                        # first new entry
+                        if cache_file.tell() > 0:
+                            cache_file.seek(-1, os.SEEK_END)
+                            if cache_file.read(1) != b"\n":
+                                data = b"\n" + data
+                        cache_file.write(data)
+        except OSError as e:
+            self.wrn(f"failed to update {cache_path}: {e}")
+
+    def _write_atomic(self, path, data):
+        # Write to a temporary file and rename it into place so that an
+        # interrupted run never leaves a partially written file behind
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            # mkstemp() always creates the file as 0600
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _prefetch(self, missing, hashes, jobs, mirror):
+        # Adds the hash of each source in missing to hashes as soon as it is
+        # prefetched, so a failure doesn't lose the hashes that succeeded
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            sources = dict(missing)
+            if mirror:
+                # Fetch all the revisions of each URL into its mirror at once,
+                # then prefetch from the mirror instead
+                revs_by_url = {}
+                for cache_key, (url, rev) in missing.items():
+                    revs_by_url.setdefault(url, {})[cache_key] = rev
+                for mirrored in executor.map(
+                    lambda u: self._update_mirror(*u), revs_by_url.items()
+                ):
+                    sources.update(mirrored)
+
+            futures = {
+                executor.submit(
+                    self._prefetch_source, sources[cache_key], missing[cache_key]
+                ): cache_key
+                for cache_key in sources
+            }
+            try:
+                for future in as_completed(futures):
+                    hashes[futures[future]] = future.result()["hash"]
+            except BaseException:
+                # Report the error as soon as the running prefetches are done
+                # instead of starting the queued ones
+                for future in futures:
+                    future.cancel()
+                executor.shutdown()
+                for future, cache_key in futures.items():
+                    if not future.cancelled() and future.exception() is None:
+                        hashes[cache_key] = future.result()["hash"]
+                raise
+
+    def _prefetch_source(self, source, fallback_source):
+        # source may be a mirror of fallback_source, which is the URL and
+        # revision from the manifest
+        try:
+            return self._nix_prefetch_git(*source)
+        except subprocess.CalledProcessError:
+            if source == fallback_source:
+                raise
+        url, rev = fallback_source
+        self.wrn(f"{url}: failed to prefetch from mirror, fetching directly")
+        return self._nix_prefetch_git(url, rev)
+
+    def _update_mirror(self, url, revs):
+        # Returns the mirror URL and commit hash to prefetch for each cache key,
+        # or nothing if the mirror could not be updated
+        mirror_path = _mirror_path(url)
+        self.dbg(f"{url}: updating mirror {mirror_path}")
+        try:
+            # Reinitializing an existing repository is harmless, and repairs a
+            # mirror whose creation was interrupted
+            self._git("init", "--bare", "--quiet", str(mirror_path))
+            # nix-prefetch-git fetches commits by hash
+            self._git(
+                "-C",
+                str(mirror_path),
+                "config",
+                "uploadpack.allowAnySHA1InWant",
+                "true",
+            )
+            # Keep a ref to every revision so they aren't garbage collected
+            self._git(
+                "-C",
+                str(mirror_path),
+                "fetch",
+                "--quiet",
+                "--no-tags",
+                url,
+                *(f"+{rev}:refs/west-nix/{key}" for key, rev in revs.items()),
+            )
+            commits = self._git(
+                "-C",
+                str(mirror_path),
+                "rev-parse",
+                *(f"refs/west-nix/{key}^{{commit}}" for key in revs),
+            ).split()
+            mirror_url = mirror_path.as_uri()
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            self.wrn(f"{url}: failed to update mirror, fetching directly: {e}")
+            return {}
+        return {key: (mirror_url, commit) for key, commit in zip(revs, commits)}
 
-            with open(cache_path, "w") as cache_file:
-                json.dump(new_cache, cache_file, indent=2)
+    def _git(self, *args):
+        return subprocess.run(
+            ["git", *args], stdout=subprocess.PIPE, check=True, text=True
+        ).stdout
 
     def _nix_prefetch_git(self, url, rev):
         result = subprocess.run(
             [
-                "nix-prefetch-git",
+                _nix_prefetch_git_path(),
                 "--url",
                 url,
                 "--rev",
@@ -218,7 +598,13 @@ nativeBuildInputs = [ lndir ];
                 "manifest-rev",
                 "--quiet",
             ],
-            capture_output=True,
+            # With --quiet, only errors are written to stderr, so let them
+            # through to the user instead of buffering them
+            stdout=subprocess.PIPE,
+            # Python creates all file descriptors as non-inheritable, so there
+            # is nothing to close. Not closing them allows subprocess to use
+            # posix_spawn() rather than fork().
+            close_fds=False,
             check=True,
         )
-        return json.loads(result.stdout)
+        return _load_json(result.stdout)